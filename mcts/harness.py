@@ -6,11 +6,14 @@
 
 
 import argparse
+import hashlib
 import json
 import os
 import pkg_resources
 import re
+import select
 import shutil
+import signal
 import socket
 import subprocess
 import sys
@@ -22,11 +25,12 @@ import webbrowser
 from cStringIO import StringIO
 from collections import OrderedDict
 from datetime import datetime
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 import marionette
 import mozdevice
 import moznetwork
-import mozprocess
 import wptserve
 
 from marionette import expected
@@ -40,7 +44,7 @@ from mozlog.structured import structuredlog, handlers, formatters, set_default_l
 from webapi_tests.semiauto import environment, server
 
 from mcts.utils.reportmanager import ReportManager
-from mcts.utils.logger.logmanager import LogManager
+from mcts.utils.logger.logmanager import LogManager, BufferedLogFile
 
 import mcts.utils.report
 from mcts.utils.report.results import KEY_MAIN
@@ -48,6 +52,13 @@ from mcts.utils.report.results import KEY_MAIN
 import mcts.utils.handlers.adb_b2g as adb_b2g
 import mcts.utils.handlers.gaiautils as gaiautils
 
+# ujson is considerably faster at parsing the subharness output, but is
+# optional; fall back to the standard library if it's not installed.
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 DeviceBackup = adb_b2g.DeviceBackup
 _adbflag = False
@@ -61,6 +72,12 @@ config_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "config.json"))
 
 retry_path = 'retry.json'
+# size of reads from subharness output
+output_chunk_size = 1 << 20
+# amount of output kept from a failed direct_log subharness
+output_tail_size = 16 * 1024
+group_cache_path = os.path.expanduser(
+    os.path.join("~", ".cache", "fxos-certsuite", "groups.json"))
 
 def setup_logging(log_f):
     global logger
@@ -73,7 +90,7 @@ def setup_logging(log_f):
 
 def load_config(path):
     with open(path) as f:
-        config = json.load(f)
+        config = json_loads(f.read())
 
     # replace command line folder separator for windows
     # because the arguments saved in config.json in unix form
@@ -86,28 +103,184 @@ def load_config(path):
                         config['suites'][i][1][k][j] = cmds.replace('/', os.sep)
 
     config["suites"] = OrderedDict(config["suites"])
+    for suite_opts in config["suites"].itervalues():
+        for k in ["run_args", "extra_files", "common_args"]:
+            suite_opts["_compiled_%s" % k] = [compile_template(item)
+                                              for item in suite_opts.get(k, [])]
     return config
 
 
-def iter_test_lists(suites_config, mode='phone'):
+def compile_template(item):
+    '''
+    Return a function that takes a substitution dict and returns item with
+    any %(...)s placeholders filled in. Items without placeholders are
+    returned as-is without being formatted.
+    '''
+    if "%" not in item:
+        return lambda subn: item
+    return lambda subn: item % subn
+
+
+def package_signature():
+    '''
+    Return a hash of the path and mtime of every file in this package,
+    including the web-platform-tests checkout and its manifest, so that
+    adding, removing or editing a test invalidates the group cache.
+    '''
+    root = os.path.dirname(os.path.abspath(__file__))
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith((".pyc", ".pyo")):
+                continue
+            path = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(path, root), os.path.getmtime(path)))
+    return hashlib.sha1(repr(sorted(files))).hexdigest()
+
+
+def arg_files(args):
+    '''
+    Return the absolute paths of the existing files named in args, either
+    directly or as the value of a --name=value argument.
+    '''
+    files = []
+    for arg in args:
+        value = arg.split("=", 1)[1] if arg.startswith("--") and "=" in arg else arg
+        if os.path.isfile(value):
+            files.append(os.path.abspath(value))
+    return files
+
+
+def group_cache_key(cmd, pkg_signature):
+    '''
+    Return the key under which the output of cmd is cached, or None if
+    the subharness executable can't be found. The key includes the mtimes
+    of the executable and of any files named in the arguments, and the
+    package signature, so changing any of them invalidates the entry.
+    '''
+    path = find_executable(cmd[0])
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    files = [[f, os.path.getmtime(f)] for f in arg_files(cmd[1:])]
+    return json.dumps([path, os.path.getmtime(path), os.getcwd(), cmd[1:],
+                       files, pkg_signature])
+
+
+def group_cache_key_valid(key, pkg_signature):
+    path, mtime, cwd, args, files, key_pkg_signature = json.loads(key)
+    if key_pkg_signature != pkg_signature:
+        return False
+    for f, f_mtime in [[path, mtime]] + files:
+        if not os.path.exists(f) or os.path.getmtime(f) != f_mtime:
+            return False
+    return True
+
+
+def load_group_cache():
+    try:
+        with open(group_cache_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_group_cache(cache, pkg_signature):
+    '''
+    Write the group cache, dropping entries for executables that have
+    changed. The file is replaced atomically so concurrent runs never see
+    a partially written cache.
+    '''
+    cache = dict((key, groups) for key, groups in cache.iteritems()
+                 if group_cache_key_valid(key, pkg_signature))
+    try:
+        cache_dir = os.path.dirname(group_cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        if sys.platform == 'win32' and os.path.exists(group_cache_path):
+            os.remove(group_cache_path)
+        os.rename(tmp_path, group_cache_path)
+    except (IOError, OSError) as e:
+        print >> sys.stderr, "Failed to write test group cache %s: %s" % (group_cache_path, e)
+
+
+def list_test_groups(name, cmd):
+    '''
+    Run a single subharness with --list-test-groups and return a tuple of
+    (subharness, command, output, error) where exactly one of output and
+    error is not None.
+    '''
+    try:
+        return name, cmd, subprocess.check_output(cmd), None
+    except (subprocess.CalledProcessError, OSError) as e:
+        return name, cmd, None, e
+
+
+def iter_test_lists(suites_config, mode='phone', use_cache=True, failures=None):
     '''
     Query each subharness for the list of test groups it can run and
-    yield a tuple of (subharness, test group) for each one.
+    yield a tuple of (subharness, test group) for each one, in config order.
+
+    Unless use_cache is False, results are cached in group_cache_path.
+    Subharnesses without a cached result are queried concurrently.
+    Subharnesses that fail are reported once the others have been listed,
+    and a (subharness, command, error) tuple for each is appended to
+    failures if a list is given.
     '''
+    if use_cache:
+        pkg_signature = package_signature()
+        cache = load_group_cache()
+    else:
+        cache = {}
+    entries = []
+    cmds = []
     for name, opts in suites_config.iteritems():
-        try:
-            cmd = [opts["cmd"], '--list-test-groups'] + opts.get("common_args", [])
+        cmd = [opts["cmd"], '--list-test-groups'] + opts.get("common_args", [])
 
-            if mode == 'stingray':
-                cmd.append('--mode')
-                cmd.append('stingray')
+        if mode == 'stingray':
+            cmd.append('--mode')
+            cmd.append('stingray')
 
-            for group in subprocess.check_output(cmd).splitlines():
+        key = group_cache_key(cmd, pkg_signature) if use_cache else None
+        entries.append((name, key, cache.get(key)))
+        if key not in cache:
+            cmds.append((name, cmd))
+
+    errors = []
+    pool = ThreadPool(len(cmds)) if cmds else None
+    try:
+        results = pool.imap(lambda item: list_test_groups(*item), cmds) if pool else iter([])
+        for name, key, groups in entries:
+            if groups is None:
+                name, cmd, output, e = next(results)
+                if e is not None:
+                    errors.append((name, cmd, e))
+                    continue
+
+                groups = output.splitlines()
+                if key is not None:
+                    cache[key] = groups
+
+            for group in groups:
                 yield name, group
-        except (subprocess.CalledProcessError, OSError) as e:
-            # There's no logger at this point in the code to log this as an exception
-            print >> sys.stderr, "Failed to run command: %s: %s" % (" ".join(cmd), e)
-            sys.exit(1)
+    finally:
+        if pool:
+            pool.terminate()
+
+    if use_cache and cmds:
+        save_group_cache(cache, pkg_signature)
+
+    for name, cmd, e in errors:
+        message = "Failed to list test groups for %s: %s: %s" % (name, " ".join(cmd), e)
+        if logger:
+            logger.warning(message)
+        else:
+            print >> sys.stderr, message
+    if failures is not None:
+        failures.extend(errors)
 
 
 def get_metadata():
@@ -138,12 +311,77 @@ class MarionetteSession(object):
             self.marionette.delete_session()
 
 
+def iter_output(proc):
+    '''
+    Yield the output of proc in chunks of up to output_chunk_size bytes.
+    Reading stops once proc has exited and its remaining output has been
+    drained, even if a grandchild still holds the pipe open. Windows can't
+    select on pipes, so there reading carries on until end of file.
+    '''
+    fd = proc.stdout.fileno()
+    while True:
+        if sys.platform != 'win32':
+            exited = proc.poll() is not None
+            ready = select.select([fd], [], [], 0 if exited else 0.1)[0]
+            if not ready:
+                if exited:
+                    break
+                continue
+        data = os.read(fd, output_chunk_size)
+        if not data:
+            break
+        yield data
+    proc.stdout.close()
+
+
+def pump_output(proc, on_output):
+    '''
+    Read the output of proc in large chunks, calling on_output with each
+    line stripped of trailing whitespace.
+    '''
+    buf = bytearray()
+    for data in iter_output(proc):
+        buf.extend(data)
+        lines = buf.split("\n")
+        buf = lines.pop()
+        for line in lines:
+            on_output(str(line).rstrip())
+    if buf:
+        on_output(str(buf).rstrip())
+
+
+def copy_output(proc, out, tail_size):
+    '''
+    Copy the output of proc to out unchanged and return its last
+    tail_size bytes.
+    '''
+    tail = ""
+    for data in iter_output(proc):
+        out.write(data)
+        tail = (tail + data)[-tail_size:]
+    out.flush()
+    return tail
+
+
+def kill_process_group(proc):
+    '''
+    Kill proc and anything it started that is still running. On POSIX the
+    subharness runs in its own process group, see TestRunner.run_test.
+    '''
+    if sys.platform == 'win32':
+        proc.kill()
+    else:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
 class TestRunner(object):
     def __init__(self, args, config):
         self.args = args
         self.config = config
         self.retry = self.loadretry()
         self.regressions = []
+        # substitutions for the %(...)s templates in the suite options
+        self.base_subn = dict((k, v) for k, v in config.iteritems() if k != "suites")
 
     def loadretry(self):
         if not self.args.retry_failed:
@@ -181,7 +419,11 @@ class TestRunner(object):
         else:
             tests = self.args.tests
 
+        # All the groups for a suite are run by a single subharness
+        # invocation, so repeated groups are dropped and a suite that is
+        # requested in full absorbs any groups requested for it.
         d = OrderedDict()
+        run_all = set()
         for t in tests:
             v = t.split(":", 1)
             suite = v[0]
@@ -190,10 +432,13 @@ class TestRunner(object):
 
             if len(v) == 2:
                 #TODO: verify tests passed against possible tests?
-                d[suite].append(v[1])
+                if v[1] not in d[suite]:
+                    d[suite].append(v[1])
+            else:
+                run_all.add(suite)
 
         for suite, groups in d.iteritems():
-            yield suite, groups
+            yield suite, [] if suite in run_all else groups
 
     def test_string(self, test_id):
         if isinstance(test_id, unicode):
@@ -249,7 +494,7 @@ class TestRunner(object):
             written = False
             if line.startswith("{"):
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     if "action" in data:
                         sub_logger.log_raw(data)
                         written = True
@@ -262,22 +507,40 @@ class TestRunner(object):
 
         try:
             cmd, output_files, structured_path = self.build_command(suite, groups, temp_dir)
+            direct_log = self.config["suites"][suite].get("direct_log", False)
 
             logger.debug(cmd)
             logger.debug(output_files)
 
             env = dict(os.environ)
             env['PYTHONUNBUFFERED'] = '1'
-            proc = mozprocess.ProcessHandler(cmd, env=env, processOutputLine=on_output)
+            # put the subharness in its own process group so that anything it
+            # leaves running can be killed along with it
+            preexec_fn = None if sys.platform == 'win32' else os.setsid
+            proc = subprocess.Popen(cmd, env=env, preexec_fn=preexec_fn,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
             logger.debug("Process '%s' is running" % " ".join(cmd))
             #TODO: move timeout handling to here instead of each test?
-            with open(structured_path, "w") as structured_log:
-                sub_logger = structuredlog.StructuredLogger(suite)
-                sub_logger.add_handler(stdio_handler)
-                sub_logger.add_handler(handlers.StreamHandler(structured_log,
-                                                              formatters.JSONFormatter()))
-                proc.run()
-                proc.wait()
+            if direct_log:
+                # The subharness writes its structured log straight to
+                # structured_path and its formatted output is passed through
+                # to the console as-is; only the end of the output of a
+                # failed run is kept in our own log.
+                tail = copy_output(proc, sys.stderr, output_tail_size)
+                if proc.wait() != 0:
+                    logger.error("Suite %s exited with status %i, last output:\n%s" %
+                                 (suite, proc.returncode, tail.decode("utf8", "replace")))
+                # the subharness may have died before opening its log
+                if not os.path.exists(structured_path):
+                    open(structured_path, "w").close()
+            else:
+                with BufferedLogFile(structured_path) as structured_log:
+                    sub_logger = structuredlog.StructuredLogger(suite)
+                    sub_logger.add_handler(stdio_handler)
+                    sub_logger.add_handler(handlers.StreamHandler(structured_log,
+                                                                  formatters.JSONFormatter()))
+                    pump_output(proc, on_output)
+                    proc.wait()
             logger.debug("Process finished")
 
         except Exception:
@@ -285,7 +548,7 @@ class TestRunner(object):
             raise
         finally:
             try:
-                proc.kill()
+                kill_process_group(proc)
             except:
                 pass
 
@@ -294,21 +557,25 @@ class TestRunner(object):
     def build_command(self, suite, groups, temp_dir):
         suite_opts = self.config["suites"][suite]
 
-        subn = self.config.copy()
-        del subn["suites"]
-        subn.update({"temp_dir": temp_dir})
+        subn = self.base_subn
+        subn["temp_dir"] = temp_dir
 
         cmd = [suite_opts['cmd']]
 
         subtests = '' if groups == [] else '_' + "_".join(item.replace("/", "-") for item in groups)
         log_name = os.sep.join([temp_dir,"%s_structured%s.log" % (suite, subtests)])
-        cmd.extend(["--log-raw=-"])
+        if suite_opts.get("direct_log", False):
+            # Let the subharness write the raw log itself so that we don't
+            # have to parse and re-serialise every line of its output
+            cmd.extend(["--log-raw=%s" % log_name, "--log-mach=-"])
+        else:
+            cmd.extend(["--log-raw=-"])
 
         if groups:
             cmd.extend('--include=%s' % g for g in groups)
 
-        cmd.extend(item % subn for item in suite_opts.get("run_args", []))
-        cmd.extend(item % subn for item in suite_opts.get("common_args", []))
+        cmd.extend(fn(subn) for fn in suite_opts["_compiled_run_args"])
+        cmd.extend(fn(subn) for fn in suite_opts["_compiled_common_args"])
 
         if self.args.debug and suite == 'webapi':
             cmd.append('-v')
@@ -320,7 +587,7 @@ class TestRunner(object):
             cmd.append(self.args.device_profile)
 
         output_files = [log_name]
-        output_files += [item % subn for item in suite_opts.get("extra_files", [])]
+        output_files += [fn(subn) for fn in suite_opts["_compiled_extra_files"]]
 
         if self.args.mode == 'stingray' and (suite == 'webapi' or suite == 'security'):
             cmd.extend([u'--host=%s' % _host, u'--port=%s' % _port, u'--mode=stingray'])
@@ -515,9 +782,12 @@ def list_tests(args, config):
             if key not in stingray_suite_keys:
                 del suites[key]
 
-    for test, group in iter_test_lists(suites, args.mode):
+    failures = []
+    for test, group in iter_test_lists(suites, args.mode,
+                                       use_cache=not args.no_group_cache,
+                                       failures=failures):
         print "%s:%s" % (test, group)
-    return True
+    return not failures
 
 def edit_device_profile(device_profile_path, message):
     resp = ''
@@ -564,7 +834,7 @@ def load_device_profile(device_profile_path):
     finally:
         return device_profile_object
 
-def prepare_device_profile(edit_profile, profile_path, suites):
+def prepare_device_profile(edit_profile, profile_path, suites, use_group_cache=True):
     profile_object = {'return': 'cancel'}
 
     if os.path.exists(profile_path):
@@ -578,7 +848,7 @@ def prepare_device_profile(edit_profile, profile_path, suites):
     if edit_profile:
         # create profile information to be displayed in profile.html
         profile_data = {}
-        for test, group in iter_test_lists(suites):
+        for test, group in iter_test_lists(suites, use_cache=use_group_cache):
             if test not in profile_data.keys():
                 profile_data[test] = []
             profile_data[test].append({
@@ -621,9 +891,11 @@ def run_tests(args, config):
 
             config['profile'] = prepare_device_profile( args.edit_device_profile,
                                                         args.device_profile,
-                                                        config['suites'])
+                                                        config['suites'],
+                                                        not args.no_group_cache)
 
-            report_manager.setup_report(args.device_profile, log_manager.zip_file, log_manager.structured_path)
+            report_manager.setup_report(args.device_profile, log_manager.zip_file,
+                                        log_manager.structured_path, log_manager.structured_file)
 
             log_metadata()
 
@@ -678,6 +950,9 @@ def get_parser():
     parser.add_argument('-l', '--list-tests',
                         help='List all tests available to run',
                         action='store_true')
+    parser.add_argument('--no-group-cache',
+                        help='Query every subharness for its test groups instead of using the cache',
+                        action='store_true', default=False)
     parser.add_argument('-r', '--retry-failed',
                         help='Retry last failed tests to run(IGNORE any tests parameters)',
                         action='store_true', default=False)
@@ -83,7 +83,7 @@ class procpid(object):
     def __init__(self):
         self.logger = get_default_logger()
         try:
-            self.dm = DeviceHelper.getDevice(runAdbAsRoot)
+            self.dm = DeviceHelper.getDevice(runAdbAsRoot=True)
         except mozdevice.DMError as e:
             self.logger.error("Error connecting to device via adb (error: %s). Please be "
                               "sure device is connected and 'remote debugging' is enabled." %
@@ -7,7 +7,10 @@
 import sys
 import logging
 import argparse
+import subprocess
 import traceback
+from collections import OrderedDict
+from distutils.spawn import find_executable
 from mozdevice import DeviceManagerADB, DMError, ADBError
 from mozlog.structured import commandline, get_default_logger
 from time import sleep
@@ -34,6 +37,25 @@ class ExtraTest(object):
         else:
             return 'unknown'
 
+    # mapping of group name to test classes, see group_index()
+    _group_index = None
+    _group_index_size = 0
+
+    @staticmethod
+    def group_index():
+        """
+        Returns an OrderedDict mapping each group name to its tests. It is
+        built on first use and rebuilt if new tests have been defined since.
+        """
+        subclasses = ExtraTest.__subclasses__()
+        if ExtraTest._group_index is None or ExtraTest._group_index_size != len(subclasses):
+            index = OrderedDict()
+            for t in subclasses:
+                index.setdefault(t.groupname(), []).append(t)
+            ExtraTest._group_index = index
+            ExtraTest._group_index_size = len(subclasses)
+        return ExtraTest._group_index
+
     @staticmethod
     def group_list(mode='phone'):
         """
@@ -41,11 +63,7 @@ class ExtraTest(object):
         """
         if mode == 'stingray':
             return ['ssl']
-        groups = []
-        for t in ExtraTest.__subclasses__():
-            if t.groupname() not in groups:
-                groups.append(t.groupname())
-        return groups
+        return list(ExtraTest.group_index())
 
     @staticmethod
     def test_list(group=None, mode='phone'):
@@ -57,11 +75,7 @@ class ExtraTest(object):
         if group is None:
             return ExtraTest.__subclasses__()
         else:
-            tests = []
-            for t in ExtraTest.__subclasses__():
-                if t.groupname() == group:
-                    tests.append(t)
-            return tests
+            return list(ExtraTest.group_index().get(group, []))
 
     @staticmethod
     def run_groups(groups=[], version=None, host='localhost', port=2828, mode='phone'):
@@ -109,21 +123,45 @@ class ExtraTest(object):
 # Shared module functionality
 #############################
 
+def backoff_delays(initial=0.05, maximum=2.0):
+    """
+    Yields poll delays starting at initial and doubling up to maximum.
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+
 def wait_for_adb_device():
+    if find_executable("adb") is not None:
+        # let adb block until a device transport appears instead of polling
+        try:
+            subprocess.check_call(["adb", "wait-for-device"])
+            DeviceHelper.getDevice(runAdbAsRoot=True)
+            return
+        except (subprocess.CalledProcessError, OSError, DMError):
+            pass
+    poll_for_adb_device()
+
+
+def poll_for_adb_device():
     try:
         adb = DeviceHelper.getDevice(runAdbAsRoot=True)
     except DMError:
         adb = None
         print "Waiting for adb connection..."
+    delays = backoff_delays()
     while adb is None:
         try:
             adb = DeviceHelper.getDevice(runAdbAsRoot=True)
         except DMError:
-            sleep(0.2)
+            sleep(next(delays))
     if len(adb.devices()) < 1:
         print "Waiting for adb device..."
+        delays = backoff_delays()
         while len(adb.devices()) < 1:
-            sleep(0.2)
+            sleep(next(delays))
 
 
 def adb_has_root():
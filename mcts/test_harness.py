@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+from collections import OrderedDict
+
+from mcts import harness
+
+
+class TestGroupCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_cache_path = harness.group_cache_path
+        harness.group_cache_path = os.path.join(self.temp_dir, "cache", "groups.json")
+        self.arg_file = os.path.join(self.temp_dir, "manifest.json")
+        with open(self.arg_file, "w") as f:
+            f.write("{}")
+        self.cmd = [sys.executable, "--list-test-groups",
+                    "--manifest=%s" % self.arg_file]
+
+    def tearDown(self):
+        harness.group_cache_path = self.orig_cache_path
+        shutil.rmtree(self.temp_dir)
+
+    def touch(self, path, delta):
+        mtime = os.path.getmtime(path) + delta
+        os.utime(path, (mtime, mtime))
+
+    def test_key_includes_arg_files(self):
+        key = harness.group_cache_key(self.cmd, "sig")
+        self.assertIn([self.arg_file, os.path.getmtime(self.arg_file)],
+                      json.loads(key)[4])
+        self.assertTrue(harness.group_cache_key_valid(key, "sig"))
+
+        self.touch(self.arg_file, 10)
+        self.assertFalse(harness.group_cache_key_valid(key, "sig"))
+        self.assertNotEqual(key, harness.group_cache_key(self.cmd, "sig"))
+
+    def test_key_includes_package_signature(self):
+        key = harness.group_cache_key(self.cmd, "sig")
+        self.assertFalse(harness.group_cache_key_valid(key, "other"))
+
+    def test_missing_executable_has_no_key(self):
+        cmd = [os.path.join(self.temp_dir, "missing"), "--list-test-groups"]
+        self.assertIsNone(harness.group_cache_key(cmd, "sig"))
+
+    def test_package_signature(self):
+        pkg_dir = os.path.join(self.temp_dir, "pkg")
+        os.makedirs(os.path.join(pkg_dir, "web-platform-tests"))
+        test_file = os.path.join(pkg_dir, "web-platform-tests", "test.html")
+        with open(test_file, "w") as f:
+            f.write("")
+        orig_file = harness.__file__
+        harness.__file__ = os.path.join(pkg_dir, "harness.py")
+        try:
+            signature = harness.package_signature()
+            self.assertEqual(signature, harness.package_signature())
+
+            with open(os.path.join(pkg_dir, "harness.pyc"), "w") as f:
+                f.write("")
+            self.assertEqual(signature, harness.package_signature())
+
+            self.touch(test_file, 10)
+            touched = harness.package_signature()
+            self.assertNotEqual(signature, touched)
+
+            os.remove(test_file)
+            self.assertNotEqual(touched, harness.package_signature())
+        finally:
+            harness.__file__ = orig_file
+
+    def test_save_and_load(self):
+        self.assertEqual(harness.load_group_cache(), {})
+
+        key = harness.group_cache_key(self.cmd, "sig")
+        harness.save_group_cache({key: ["a", "b"]}, "sig")
+        self.assertEqual(harness.load_group_cache(), {key: ["a", "b"]})
+        self.assertEqual(os.listdir(os.path.dirname(harness.group_cache_path)),
+                         ["groups.json"])
+
+    def test_save_drops_stale_entries(self):
+        stale = harness.group_cache_key(self.cmd, "sig")
+        self.touch(self.arg_file, 10)
+        fresh = harness.group_cache_key(self.cmd, "sig")
+        harness.save_group_cache({stale: ["a"], fresh: ["b"]}, "sig")
+        self.assertEqual(harness.load_group_cache(), {fresh: ["b"]})
+
+        harness.save_group_cache(harness.load_group_cache(), "other")
+        self.assertEqual(harness.load_group_cache(), {})
+
+    def test_load_corrupt_cache(self):
+        os.makedirs(os.path.dirname(harness.group_cache_path))
+        with open(harness.group_cache_path, "w") as f:
+            f.write("{")
+        self.assertEqual(harness.load_group_cache(), {})
+
+
+class TestIterTestLists(unittest.TestCase):
+    def setUp(self):
+        self.orig = harness.package_signature, harness.list_test_groups
+        self.suites = {"cert": {"cmd": sys.executable}}
+
+        def list_test_groups(name, cmd):
+            return name, cmd, "a\nb\n", None
+        harness.list_test_groups = list_test_groups
+
+    def tearDown(self):
+        harness.package_signature, harness.list_test_groups = self.orig
+
+    def test_no_cache_skips_signature(self):
+        def package_signature():
+            raise AssertionError("package signature computed")
+        harness.package_signature = package_signature
+        self.assertEqual(list(harness.iter_test_lists(self.suites, use_cache=False)),
+                         [("cert", "a"), ("cert", "b")])
+
+    def test_failures(self):
+        error = OSError("failed")
+
+        def list_test_groups(name, cmd):
+            if name == "webapi":
+                return name, cmd, None, error
+            return name, cmd, "a\n", None
+        harness.list_test_groups = list_test_groups
+
+        suites = OrderedDict([("webapi", {"cmd": sys.executable}),
+                              ("cert", {"cmd": sys.executable})])
+        failures = []
+        self.assertEqual(list(harness.iter_test_lists(suites, use_cache=False,
+                                                      failures=failures)),
+                         [("cert", "a")])
+        self.assertEqual([(name, e) for name, cmd, e in failures],
+                         [("webapi", error)])
+
+
+class TestIterSuites(unittest.TestCase):
+    def iter_suites(self, tests):
+        args = Namespace(tests=tests, retry_failed=False, mode="phone")
+        config = {"suites": OrderedDict([("cert", {}), ("webapi", {})])}
+        return list(harness.TestRunner(args, config).iter_suites())
+
+    def test_default(self):
+        self.assertEqual(self.iter_suites([]), [("cert", []), ("webapi", [])])
+
+    def test_groups_merged(self):
+        self.assertEqual(self.iter_suites(["webapi:a", "cert", "webapi:b", "webapi:a"]),
+                         [("webapi", ["a", "b"]), ("cert", [])])
+
+    def test_run_all_absorbs_groups(self):
+        self.assertEqual(self.iter_suites(["webapi:a", "webapi", "webapi:b"]),
+                         [("webapi", [])])
+
+
+if __name__ == '__main__':
+    unittest.main()
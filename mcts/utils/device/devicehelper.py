@@ -12,15 +12,16 @@ class DeviceHelper(object):
     @staticmethod
     def getDevice(DeviceManager=DeviceManagerADB, **kwargs):
         if not DeviceHelper.device:
+            # hasadb is ours, not the device manager's
+            hasadb = kwargs.pop('hasadb', True)
             DeviceHelper.device = DeviceManager(**kwargs)
-            
+
             # forward only once after creating the device manager object
-            hasadb = kwargs.pop('hasadb', True)
             if hasadb:
                 DeviceHelper.device.forward("tcp:2828", "tcp:2828")
 
         return DeviceHelper.device
-    
+
     @staticmethod
     def getMarionette(host='localhost', port=2828):
         if not DeviceHelper.marionette:
@@ -4,6 +4,8 @@ import os
 import posixpath
 import re
 import shutil
+import subprocess
+import tarfile
 import tempfile
 import time
 import traceback
@@ -18,6 +20,24 @@ class WaitTimeout(Exception):
     pass
 
 
+# written after the tar stream in DeviceBackup._bulk_pull, followed by
+# tar's exit status
+TAR_STATUS_MARKER = "FXOS_TAR_STATUS="
+
+
+class TailReader(object):
+    """Wraps a file object, remembering the last bytes read from it."""
+    def __init__(self, f, size=64):
+        self.f = f
+        self.size = size
+        self.tail = ""
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.tail = (self.tail + data)[-self.size:]
+        return data
+
+
 class DeviceBackup(object):
     def __init__(self, backup_dirs=None, backup_files=None):
         self.device = ADBB2G()
@@ -32,6 +52,9 @@ class DeviceBackup(object):
             backup_files = ["/system/etc/hosts"]
         self.backup_files = backup_files
 
+        # whether the device can stream a tar archive, see bulk_supported()
+        self._bulk_supported = None
+
     def local_dir(self, remote):
         return os.path.join(self.backup_path, remote.lstrip("/"))
 
@@ -46,19 +69,19 @@ class DeviceBackup(object):
         self.logger.info("Backing up device")
         self.backup_path = tempfile.mkdtemp()
 
-        for remote_path in self.backup_dirs:
-            local_path = self.local_dir(remote_path)
-            if not os.path.exists(local_path):
-                os.makedirs(local_path)
-            self.device.pull(remote_path, local_path)
+        if not self.bulk_supported():
+            self.logger.info("Device can't stream a tar archive, pulling each path")
+            self._pull_each()
+            return self
 
-        for remote_path in self.backup_files:
-            remote_dir, filename = remote_path.rsplit("/", 1)
-            local_dir = self.local_dir(remote_dir)
-            local_path = os.path.join(local_dir, filename)
-            if not os.path.exists(local_dir):
-                os.makedirs(local_dir)
-            self.device.pull(remote_path, local_path)
+        try:
+            self._bulk_pull(self.backup_dirs + self.backup_files)
+        except (adb.ADBError, adb.ADBTimeoutError, tarfile.TarError, EnvironmentError) as e:
+            self.logger.warning("Bulk backup failed (%s), falling back to per-path pull" % e)
+            # don't let a partial extraction mix with the per-path copy
+            shutil.rmtree(self.backup_path)
+            os.makedirs(self.backup_path)
+            self._pull_each()
 
         return self
 
@@ -77,6 +100,77 @@ class DeviceBackup(object):
             self.device.rm(remote_path, recursive=True)
             self.device.push(local_path, remote_path)
 
+    def _adb_command(self, *args):
+        cmd = [self.device._adb_path]
+        if self.device._device_serial:
+            cmd.extend(["-s", self.device._device_serial])
+        cmd.extend(args)
+        return cmd
+
+    def bulk_supported(self):
+        """Return whether both adb and the device support streaming a tar
+        archive with exec-out. Checked once per DeviceBackup by archiving a
+        single small file."""
+        if self._bulk_supported is None:
+            cmd = self._adb_command("exec-out", "tar -cf /dev/null -C / system/build.prop && echo ok")
+            try:
+                with open(os.devnull, "w") as devnull:
+                    output = subprocess.check_output(cmd, stderr=devnull)
+                self._bulk_supported = output.strip() == "ok"
+            except (subprocess.CalledProcessError, EnvironmentError):
+                self._bulk_supported = False
+        return self._bulk_supported
+
+    def _bulk_pull(self, paths):
+        """Pull all of paths from the device in a single tar stream and
+        extract them under backup_path, so that each remote path ends up at
+        local_dir(path)."""
+        # exec-out doesn't pass on the exit status of the remote command, so
+        # tar's status is appended to the stream after the archive
+        cmd = self._adb_command("exec-out", "tar -cf - -C / %s; echo %s$?" %
+                                (" ".join(path.lstrip("/") for path in paths),
+                                 TAR_STATUS_MARKER))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        stream = TailReader(proc.stdout)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                tar.extractall(self.backup_path)
+            # read the padding after the archive and the status line
+            while stream.read(1 << 16):
+                pass
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise adb.ADBError("%s exited with status %i" %
+                                   (" ".join(cmd), proc.returncode))
+
+        status = re.search(r"%s(\d+)\s*$" % TAR_STATUS_MARKER, stream.tail)
+        if status is None or status.group(1) != "0":
+            raise adb.ADBError("tar failed on device%s" %
+                               (" with status %s" % status.group(1) if status else ""))
+
+        missing = [path for path in self.backup_dirs
+                   if not os.path.isdir(self.local_dir(path))]
+        missing += [path for path in self.backup_files
+                    if not os.path.isfile(self.local_dir(path))]
+        if missing:
+            raise adb.ADBError("Bulk backup is missing %s" % ", ".join(missing))
+
+    def _pull_each(self):
+        for remote_path in self.backup_dirs:
+            local_path = self.local_dir(remote_path)
+            if not os.path.exists(local_path):
+                os.makedirs(local_path)
+            self.device.pull(remote_path, local_path)
+
+        for remote_path in self.backup_files:
+            remote_dir, filename = remote_path.rsplit("/", 1)
+            local_dir = self.local_dir(remote_dir)
+            local_path = os.path.join(local_dir, filename)
+            if not os.path.exists(local_dir):
+                os.makedirs(local_dir)
+            self.device.pull(remote_path, local_path)
+
     def cleanup(self):
         shutil.rmtree(self.backup_path)
 
@@ -96,7 +190,13 @@ class PushFile(object):
         self.device.rm(self.remote)
 
 
-def poll_wait(func, polling_interval=1.0, timeout=30, after_first=None):
+def poll_wait(func, polling_interval=1.0, timeout=30, after_first=None,
+              max_polling_interval=None):
+    """Call func until it returns a true value or timeout seconds elapse.
+
+    If max_polling_interval is set, the interval between calls starts at
+    polling_interval and doubles after each attempt up to that maximum.
+    """
     start_time = time.time()
     ran_first = False
 
@@ -115,6 +215,9 @@ def poll_wait(func, polling_interval=1.0, timeout=30, after_first=None):
         time.sleep(sleep)
         current_time = time.time()
 
+        if max_polling_interval is not None:
+            polling_interval = min(polling_interval * 2, max_polling_interval)
+
     raise WaitTimeout()
 
 
@@ -128,7 +231,8 @@ class ADBB2G(adb.ADBDevice):
 
         adb.ADBDevice.__init__(self, *args, **kwargs)
 
-    def wait_for_device_ready(self, timeout=None, wait_polling_interval=None, after_first=None):
+    def wait_for_device_ready(self, timeout=None, wait_polling_interval=None, after_first=None,
+                              max_polling_interval=None):
         """Wait for the device to become ready for reliable interaction via adb.
         NOTE: if the device is *already* ready this method will timeout.
 
@@ -137,6 +241,8 @@ class ADBB2G(adb.ADBDevice):
         :param after_first: A function to run after first polling for device
                             readiness. This allows use cases such as stopping b2g
                             setting the unready state, and then restarting b2g.
+        :param max_polling_interval: If set, the polling interval doubles after
+                                     each poll up to this maximum.
         """
 
         if timeout is None:
@@ -186,7 +292,8 @@ class ADBB2G(adb.ADBDevice):
             return inner
 
         poll_wait(prefs_modified(), timeout=timeout,
-                  polling_interval=wait_polling_interval, after_first=after_first)
+                  polling_interval=wait_polling_interval, after_first=after_first,
+                  max_polling_interval=max_polling_interval)
 
     def wait_for_net(self, timeout=None, wait_polling_interval=None):
         """Wait for the device to be assigned an IP address.
@@ -247,16 +354,21 @@ class ADBB2G(adb.ADBDevice):
         """Reboot the device, waiting for the adb connection to become stable.
 
         :param timeout: Maximum time to wait for reboot.
-        :param wait_polling_interval: Interval at which to poll for device readiness.
+        :param wait_polling_interval: Initial interval at which to poll for
+                                      device readiness; doubles up to 2s.
         """
         if timeout is None:
             timeout = self._timeout
         if wait_polling_interval is None:
-            wait_polling_interval = self._wait_polling_interval
+            wait_polling_interval = min(self._wait_polling_interval, 0.5)
 
         self._logger.info("Rebooting device")
+        start_time = time.time()
         self.wait_for_device_ready(timeout,
-                                   after_first=lambda:self.command_output(["reboot"]))
+                                   wait_polling_interval=wait_polling_interval,
+                                   after_first=lambda:self.command_output(["reboot"]),
+                                   max_polling_interval=max(wait_polling_interval, 2.0))
+        self._logger.info("Device rebooted in %.1fs" % (time.time() - start_time))
 
     def root(self, timeout=None, wait_polling_interval=None):
         """run adbd as root. 
@@ -9,6 +9,50 @@ from datetime import datetime
 
 from mozlog.structured import get_default_logger
 
+# Size of the userspace buffer used for structured log files
+LOG_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Extensions of files that are already compressed
+COMPRESSED_EXTENSIONS = (".gz", ".zst", ".bz2", ".xz", ".zip", ".ja", ".png", ".jpg")
+
+def compression_for(path):
+    """
+    Returns the zip compression type to use for path; files that are
+    already compressed are stored rather than deflated again.
+    """
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+class BufferedLogFile(object):
+    """
+    Write-only file for structured log handlers. mozlog's StreamHandler
+    flushes after every message; those flushes are ignored here so that
+    data only reaches the disk when the buffer fills or the file is closed.
+    """
+    def __init__(self, path, mode="w", buffering=LOG_BUFFER_SIZE):
+        self.name = path
+        self._file = open(path, mode, buffering)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        """Write any buffered data out so the file can be read back."""
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 class LogManager(object):
     def __init__(self):
         self.time = datetime.now()
@@ -17,12 +61,14 @@ class LogManager(object):
         self.structured_file = None
         self.subsuite_results = []
 
-    def add_file(self, path, file_obj):
-        self.zip_file.write(path, file_obj)
+    def add_file(self, path, file_obj=None, compression=None):
+        if compression is None:
+            compression = compression_for(path)
+        self.zip_file.write(path, file_obj, compression)
 
     def __enter__(self):
         self.zip_file = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED)
-        self.structured_file = open(self.structured_path, "w")
+        self.structured_file = BufferedLogFile(self.structured_path)
         return self
 
     def __exit__(self, ex_type, ex_value, tb):
@@ -34,7 +80,7 @@ class LogManager(object):
             for handle in logger.handlers:
                 logger.remove_handler(handle);
             self.structured_file.close()
-            self.zip_file.write(self.structured_path)
+            self.add_file(self.structured_path)
         finally:
             try:
                 os.unlink(self.structured_path)
@@ -8,6 +8,8 @@ import os
 
 from datetime import datetime
 
+from mcts.utils.logger.logmanager import compression_for
+
 class ReportManager(object):
     def __init__(self):
         reload(sys)
@@ -15,12 +17,14 @@ class ReportManager(object):
         self.zip_file = None
         self.subsuite_results = {}
         self.structured_path = None
+        self.structured_file = None
 
     def setup_report(self, profile_path, zip_file = None,
-        structured_path = None):
+        structured_path = None, structured_file = None):
         self.time = datetime.now()
         self.zip_file = zip_file
         self.structured_path = structured_path
+        self.structured_file = structured_file
         self.profile_path = profile_path
 
     def __enter__(self):
@@ -28,6 +32,8 @@ class ReportManager(object):
 
     def __exit__(self, *args, **kwargs):
         if self.structured_path:
+            if self.structured_file:
+                self.structured_file.sync()
             self.add_summary_report(self.structured_path)
 
     def add_subsuite_report(self, path, result_files):
@@ -40,7 +46,8 @@ class ReportManager(object):
                 file_name = os.path.split(path)[1]
                 with open(path, 'r') as f:
                     files_map[file_name] = f.read()
-                self.zip_file.writestr("%s/%s" % (results.name, os.path.basename(path)), files_map[file_name])
+                self.zip_file.writestr("%s/%s" % (results.name, os.path.basename(path)), files_map[file_name],
+                                       compression_for(path))
         results.set('files', files_map)
 
         self.subsuite_results[results.name] = {}